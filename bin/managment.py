@@ -11,12 +11,25 @@ import time
 from datetime import datetime
 import uuid
 
+from simplequeue import get_partitions, get_routing
+
 try:
     from terminaltables import AsciiTable
     HAS_TAB = True
 except:
     HAS_TAB = False
 
+# Hand over a partition, unless its current owner is processing a message from it
+# KEYS: partitions assignment, management key of the current owner
+# ARGV: partition, new owner
+MOVE_PARTITION = """
+if redis.call('HGET', KEYS[2], 'partition') == ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
+
 
 class Manager():
 
@@ -30,11 +43,16 @@ class Manager():
         with open(startup_path) as f:
             self.startup_path = startup_path
             self.startup = json.load(f)
+        # Fail before anything is started
+        for module, config in self.pipeline.items():
+            get_partitions(module, config)
+            get_routing(module, config)
         self.queues = {}
         self.default_redis = redis.StrictRedis(host=self.runtime['Default']['host'],
                                                port=self.runtime['Default']['port'],
                                                db=self.runtime['Default']['db'],
                                                decode_responses=True)
+        self.move_partition = self.default_redis.register_script(MOVE_PARTITION)
         self.cleanup_mgmt()
 
     def _is_pid_running(self, pid):
@@ -88,11 +106,16 @@ class Manager():
                 nb_processes = 1
             p.sadd('running_modules', module)
             p.hset('config_{}'.format(module), 'nb_processes', nb_processes)
+            partitions = get_partitions(module, self.pipeline.get(module, {}))
+            if partitions:
+                # Has to be set before the processes start
+                self.default_redis.hset('config_{}'.format(module), 'partitions', partitions)
             pids = []
             for i in range(nb_processes):
                 pid = self._start_process(module)
                 pids.append(pid)
             p.sadd('pids_{}'.format(module), *pids)
+            self.balance_partitions(module, pids)
         p.execute()
 
     def _start_process(self, module):
@@ -101,6 +124,48 @@ class Manager():
         args = shlex.split(cmd)
         return subprocess.Popen(args).pid
 
+    def balance_partitions(self, module, pids):
+        '''Spread the partitions of the module between its processes, moving as few of them as possible'''
+        nb_partitions = self.default_redis.hget('config_{}'.format(module), 'partitions')
+        if not nb_partitions or not pids:
+            return
+        pids = [str(p) for p in pids]
+        assignment = self.default_redis.hgetall('partitions_{}'.format(module))
+        owned = {p: [] for p in pids}
+        free = []
+        for partition in range(int(nb_partitions)):
+            owner = assignment.get(str(partition))
+            if owner in owned:
+                owned[owner].append(partition)
+            else:
+                # Never assigned, or the owner is gone
+                free.append(partition)
+        # The processes already owning the most partitions keep the extra ones
+        base, extra = divmod(int(nb_partitions), len(pids))
+        by_load = sorted(pids, key=lambda p: len(owned[p]), reverse=True)
+        quotas = {p: base + (1 if i < extra else 0) for i, p in enumerate(by_load)}
+        for p in pids:
+            while len(owned[p]) < quotas[p] and free:
+                partition = free.pop()
+                self.default_redis.hset('partitions_{}'.format(module), partition, p)
+                owned[p].append(partition)
+        for owner in pids:
+            # Give up the idle partitions first, the one being processed would be refused
+            busy = self.default_redis.hget('module_{}_{}'.format(module, owner), 'partition')
+            candidates = sorted(owned[owner], key=lambda partition: (str(partition) == busy, -partition))
+            for partition in candidates:
+                if len(owned[owner]) <= quotas[owner]:
+                    break
+                taker = next((p for p in pids if len(owned[p]) < quotas[p]), None)
+                if taker is None:
+                    break
+                if not self.move_partition(keys=['partitions_{}'.format(module), 'module_{}_{}'.format(module, owner)],
+                                           args=[partition, taker]):
+                    # The owner started processing a message of this partition, try another one
+                    continue
+                owned[owner].remove(partition)
+                owned[taker].append(partition)
+
     def update_running_modules(self):
         if not self.default_redis.exists('running_modules'):
             return
@@ -120,6 +185,7 @@ class Manager():
                     cur_pids.append(pid)
             pipe.delete('pids_{}'.format(module))
             pipe.sadd('pids_{}'.format(module), *cur_pids)
+            self.balance_partitions(module, cur_pids)
         pipe.execute()
 
     def stop_modules(self):
@@ -131,6 +197,7 @@ class Manager():
             [os.kill(p, 9) for p in running_processes if p]
             pipe.delete('config_{}'.format(module))
             pipe.delete('pids_{}'.format(module))
+            pipe.delete('partitions_{}'.format(module))
         pipe.delete('running_modules')
         pipe.execute()
 
@@ -157,7 +224,14 @@ class Manager():
             status_queues['{}in'.format(m)] = []
             status_queues['{}out'.format(m)] = []
             status_queues['{}in_delayed'.format(m)] = []
-            inqueue = self.default_redis.sscan('{}in'.format(m), count=3)[1]
+            partitions = self.default_redis.hget('config_{}'.format(m), 'partitions')
+            if partitions:
+                # The input is one list per partition
+                inqueue = []
+                for i in range(int(partitions)):
+                    inqueue += self.default_redis.lrange('{}in_{}'.format(m, i), 0, 2)
+            else:
+                inqueue = self.default_redis.sscan('{}in'.format(m), count=3)[1]
             delayed_queue = self.default_redis.zscan('{}in_delayed'.format(m), count=7)[1]
             outqueue = self.default_redis.sscan('{}out'.format(m), count=3)[1]
             if inqueue:
@@ -234,6 +308,7 @@ class Manager():
             pipe.delete('module_{}'.format(m))
             pipe.delete('pids_{}'.format(m))
             pipe.delete('config_{}'.format(m))
+            pipe.delete('partitions_{}'.format(m))
         pipe.delete('modules')
         pipe.delete('status')
         pipe.delete('status_queues')
@@ -11,9 +11,74 @@ import redis
 import time
 import json
 import os
+import zlib
 from datetime import datetime
 
 from .logging import Log
+from .routing import Message, Route, lookup
+
+# Pop the next message from the partitions owned by a process, and flag the partition as being
+# processed until the next call, so the manager never hands it over in the middle of a message.
+# Every key touched is passed in KEYS: the lists are the partitions owned at the previous call,
+# and the script returns the current ones for the next call. The keys are not in the same hash
+# slot, like everything else in the queues they expect a single Redis node, not a cluster.
+# KEYS: partitions assignment, management key of the process, lists of the partitions
+# ARGV: pid, counter used to rotate between the partitions, partitions matching the lists
+POP_PARTITION = """
+redis.call('HSET', KEYS[2], 'partition', '')
+local data = false
+local size = 0
+local nb = #KEYS - 2
+for i = 1, nb do
+    local j = (i + tonumber(ARGV[2])) % nb + 3
+    local partition = ARGV[j]
+    -- The partition may have been handed over since the previous call
+    if redis.call('HGET', KEYS[1], partition) == ARGV[1] then
+        if not data then
+            data = redis.call('LPOP', KEYS[j])
+            if data then
+                redis.call('HSET', KEYS[2], 'partition', partition)
+            end
+        end
+        size = size + redis.call('LLEN', KEYS[j])
+    end
+end
+local owned = {}
+local assignment = redis.call('HGETALL', KEYS[1])
+for i = 1, #assignment, 2 do
+    if assignment[i + 1] == ARGV[1] then
+        table.insert(owned, assignment[i])
+    end
+end
+return {data, size, owned}
+"""
+
+
+def get_partitions(module_name, module_config):
+    '''Number of partitions of the input queue of a module, None if it isn't partitioned'''
+    if not module_config.get('partition-key'):
+        return None
+    partitions = module_config.get('partitions')
+    if isinstance(partitions, bool) or not isinstance(partitions, int) or partitions < 1:
+        raise ValueError('{}: partitions must be an integer >= 1 when partition-key is set, got {}.'.format(
+            module_name, partitions))
+    return partitions
+
+
+def get_routing(module_name, module_config):
+    '''Compiled routing rules of the destinations of a module'''
+    routing = module_config.get('routing', {})
+    if not isinstance(routing, dict):
+        raise ValueError('{}: routing must map destination queues to rules, got {}.'.format(module_name, routing))
+    routes = {}
+    for dst, rules in routing.items():
+        if not rules:
+            continue
+        try:
+            routes[dst] = Route(rules)
+        except ValueError as e:
+            raise ValueError('{} (routing to {}): {}'.format(module_name, dst, e))
+    return routes
 
 
 class ModuleConnector(object):
@@ -31,7 +96,14 @@ class ModuleConnector(object):
         self.r.sadd('modules', self.module_name)
         self.r.sadd('module_{}'.format(self.module_name), os.getpid())
         self.mgmt_key = 'module_{}_{}'.format(self.module_name, os.getpid())
-        self.r.hmset(self.mgmt_key, {'uuid': None, 'in': 0, 'out': 0, 'size_in': 0, 'size_out': 0})
+        self.r.hmset(self.mgmt_key, {'uuid': None, 'in': 0, 'out': 0, 'size_in': 0, 'size_out': 0,
+                                     'partition': ''})
+        # Set by the manager before the process is started if the input queue is partitioned
+        self.partitioned = self.r.hexists('config_{}'.format(self.module_name), 'partitions')
+        if self.partitioned:
+            self.pop_partition = self.r.register_script(POP_PARTITION)
+            self.owned = []
+            self.nb_received = 0
 
     def sleep(self, interval):
         """Requests the pipeline to sleep for the given interval"""
@@ -40,17 +112,26 @@ class ModuleConnector(object):
     def send(self, msg):
         '''Push a messages to the temporary exit queue (multiprocess)'''
         self.r.sadd(self.out_set, json.dumps(msg))
-        self.r.hmset(self.mgmt_key, {'uuid': None, 'out': datetime.now().isoformat(),
-                                     'size_out': self.r.scard(self.out_set),
-                                     'size_in': self.r.scard(self.in_set)})
+        mgmt = {'uuid': None, 'out': datetime.now().isoformat(), 'size_out': self.r.scard(self.out_set)}
+        if not self.partitioned:
+            # The size of the partitions is updated in receive
+            mgmt['size_in'] = self.r.scard(self.in_set)
+        self.r.hmset(self.mgmt_key, mgmt)
 
     def receive(self):
         '''Pop a messages from the temporary queue (multiprocess)'''
-        data = self.r.spop(self.in_set)
+        if self.partitioned:
+            keys = ['partitions_{}'.format(self.module_name), self.mgmt_key]
+            keys += ['{}_{}'.format(self.in_set, p) for p in self.owned]
+            data, size_in, self.owned = self.pop_partition(keys=keys, args=[os.getpid(), self.nb_received] + self.owned)
+            self.nb_received += 1
+        else:
+            data = self.r.spop(self.in_set)
+            size_in = self.r.scard(self.in_set)
         # The UUID is removed in the send function, if called. If the module has no output,
         # it will never be removed if it isn't done manually in the module itself
         self.r.hmset(self.mgmt_key, {'in': datetime.now().isoformat(),
-                                     'size_in': self.r.scard(self.in_set),
+                                     'size_in': size_in,
                                      'size_out': self.r.scard(self.out_set),
                                      'uuid': None})
         if not data:
@@ -84,16 +165,19 @@ class QueueManager(object):
             if msg.get('data'):
                 return json.loads(msg['data'])
 
-        def setup_publish(self, queue_name, queue_config):
+        def setup_publish(self, queue_name, queue_config, route=None):
             r = redis.StrictRedis(host=queue_config['host'],
                                   port=queue_config['port'],
                                   db=queue_config['db'],
                                   decode_responses=True)
-            self.publishers.append((r, queue_name))
+            self.publishers.append((r, queue_name, route))
 
         def publish(self, message):
-            for p, queue_name in self.publishers:
-                p.publish(queue_name, message)
+            # The message is decoded at most once, and only if a route cannot be decided on the raw string
+            msg = Message(message)
+            for p, queue_name, route in self.publishers:
+                if route is None or route.match(msg):
+                    p.publish(queue_name, message)
 
     def __init__(self, pipeline, module_name, runtime):
         with open(runtime, 'r') as f:
@@ -113,16 +197,65 @@ class QueueManager(object):
         self.out_set = self.module_name + 'out'
         self.source = self.modules[self.module_name].get('source-queue')
         self.destinations = self.modules[self.module_name].get('destination-queues')
+        self.routes = get_routing(self.module_name, self.modules[self.module_name])
+        self.partition_key = self.modules[self.module_name].get('partition-key')
+        self.partitions = get_partitions(self.module_name, self.modules[self.module_name])
+        if self.partition_key:
+            self.partition_path = self.partition_key.split('.')
         self.log.info('Queue for {} initialized.'.format(self.module_name))
 
+    def partition(self, msg):
+        '''Partition of a message, stable across processes and restarts.
+
+        The partition-key is a dotted path resolved like the fields of the routing rules: lists
+        along the path are flattened and only the first value found is hashed, so a list-valued
+        key (or a path crossing a list) is partitioned on its first element. A missing key is
+        hashed as null, all these messages go to the same partition.
+        '''
+        key = next(lookup(msg, self.partition_path), None)
+        return (zlib.crc32(json.dumps(key, sort_keys=True).encode()) & 0xffffffff) % self.partitions
+
+    def push_in(self, msg):
+        if self.partition_key:
+            # One ordered list per partition, popped by the process owning it
+            self.r_temp.rpush('{}_{}'.format(self.in_set, self.partition(msg)), json.dumps(msg))
+        else:
+            self.r_temp.sadd(self.in_set, json.dumps(msg))
+
+    def requeue_leftovers(self):
+        '''Push again the messages left in input keys no process reads anymore: the set if the input
+        is now partitioned, the partitions out of range if there are now less or none of them.'''
+        leftovers = {}
+        for key in self.r_temp.scan_iter(match='{}_*'.format(self.in_set)):
+            partition = key[len(self.in_set) + 1:]
+            if partition.isdigit() and (not self.partition_key or int(partition) >= self.partitions):
+                leftovers[key] = self.r_temp.lpop
+        if self.partition_key and self.r_temp.scard(self.in_set):
+            leftovers[self.in_set] = self.r_temp.spop
+        for key, pop in leftovers.items():
+            nb = 0
+            while True:
+                value = pop(key)
+                if value is None:
+                    break
+                self.push_in(json.loads(value))
+                nb += 1
+            if nb:
+                self.log.warning('{}: {} message(s) left in {} by a previous configuration pushed again.'.format(
+                    self.module_name, nb, key))
+
     def check_delayed(self):
         now = int(time.time())
-        for value in self.r_temp.zrange('{}_delayed'.format(self.in_set), 0, now):
+        # Only the messages due by now, removed in the same transaction so they are pushed once
+        p = self.r_temp.pipeline()
+        p.zrangebyscore('{}_delayed'.format(self.in_set), 0, now)
+        p.zremrangebyscore('{}_delayed'.format(self.in_set), 0, now)
+        due, _ = p.execute()
+        for value in due:
             if value:
                 msg = json.loads(value)
                 msg.pop('run_at', None)
-                self.r_temp.sadd(self.in_set, json.dumps(msg))
-        self.r_temp.zremrangebyscore('{}_delayed'.format(self.in_set), 0, now)
+                self.push_in(msg)
 
     def populate_set_in(self):
         '''Push all the messages addressed to the queue in a temporary redis set (mono process)'''
@@ -131,11 +264,15 @@ class QueueManager(object):
             queue_config = self.runtime['Default']
         self.pubsub.setup_subscribe(self.source, queue_config)
         self.log.info('{} subscribing to input queue: {}.'.format(self.module_name, self.source))
+        if self.partition_key:
+            self.log.info('{} partitions its input on {} ({} partitions).'.format(self.module_name, self.partition_key,
+                                                                                 self.partitions))
+        self.requeue_leftovers()
         while True:
             msg = self.pubsub.subscribe()
             if msg:
                 if not msg.get('run_at'):
-                    self.r_temp.sadd(self.in_set, json.dumps(msg))
+                    self.push_in(msg)
                 else:
                     self.r_temp.zadd('{}_delayed'.format(self.in_set), msg.get('run_at'), json.dumps(msg))
             else:
@@ -147,12 +284,18 @@ class QueueManager(object):
         if self.destinations is None:
             self.log.info('{} has no output queue.'.format(self.module_name))
             return False
+        for dst in self.routes:
+            if dst not in self.destinations:
+                self.log.warning('{} has routing rules for {}, which is not a destination queue.'.format(self.module_name, dst))
         # We can have multiple publisher
         for dst in self.destinations:
             queue_config = self.runtime.get(dst)
             if queue_config is None:
                 queue_config = self.runtime['Default']
-            self.pubsub.setup_publish(dst, queue_config)
+            route = self.routes.get(dst)
+            if route:
+                self.log.info('{} routes messages to {} with {} rule(s).'.format(self.module_name, dst, len(route.rules)))
+            self.pubsub.setup_publish(dst, queue_config, route)
         self.log.info('{} ready to publish to {}.'.format(self.module_name, ', '.join(self.destinations)))
         while True:
             message = self.r_temp.spop(self.out_set)
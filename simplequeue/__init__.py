@@ -1,4 +1,4 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from .Helper import ModuleConnector, QueueManager
+from .Helper import ModuleConnector, QueueManager, get_partitions, get_routing
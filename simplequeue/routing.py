@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Routing helper module
+=====================
+
+Content-based routing for the output queues. The rules of a destination are
+defined in the ``routing`` section of a module in pipeline.conf:
+
+    "routing": {
+        "Processing": [
+            {"field": "type", "in": ["Event", "Attribute"]},
+            {"field": "Event.Tag.name", "equals": "tlp:white"},
+            {"field": "Event.Attribute", "exists": true}
+        ]
+    }
+
+All the rules of a destination have to match for a message to be published to
+it, destinations without rules get every message. A field is a dotted path in
+the message, lists found along the path match if any of their elements matches
+(an empty list is considered as a missing field).
+
+The rules are compiled once, when the queue starts. Each of them carries the
+JSON tokens that must appear in the raw message for the rule to possibly
+match, which allows to discard most of the messages without decoding them.
+"""
+import json
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+def lookup(data, path):
+    '''Yield all the values found at the end of the path (list of keys)'''
+    if isinstance(data, list):
+        for d in data:
+            for v in lookup(d, path):
+                yield v
+    elif not path:
+        yield data
+    elif isinstance(data, dict) and path[0] in data:
+        for v in lookup(data[path[0]], path[1:]):
+            yield v
+
+
+class Message(object):
+    '''Raw message popped from the out set, only decoded on demand'''
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = json.loads(self.raw)
+        return self._data
+
+
+class Rule(object):
+
+    operators = ('equals', 'in', 'exists')
+
+    def __init__(self, rule):
+        if not isinstance(rule, dict):
+            raise ValueError('Routing rule must be a dict: {}'.format(rule))
+        if not rule.get('field'):
+            raise ValueError('Routing rule without field: {}'.format(rule))
+        if not isinstance(rule['field'], string_types):
+            raise ValueError('Routing rule field must be a string: {}'.format(rule))
+        operators = [o for o in self.operators if o in rule]
+        if len(operators) != 1:
+            raise ValueError('Routing rule needs exactly one of {}: {}'.format(', '.join(self.operators), rule))
+        self.path = rule['field'].split('.')
+        self.operator = operators[0]
+        if self.operator == 'equals':
+            self.values = [rule['equals']]
+        elif self.operator == 'in':
+            if not isinstance(rule['in'], list):
+                raise ValueError('Routing rule "in" requires a list: {}'.format(rule))
+            self.values = rule['in']
+        else:
+            self.present = bool(rule['exists'])
+        # The key of the last level of the path is always in the raw message if the field is present
+        self.key_token = json.dumps(self.path[-1])
+        # Only strings have a single JSON representation (1 == 1.0 but '1' != '1.0')
+        self.value_tokens = None
+        if self.operator != 'exists' and all(isinstance(v, string_types) for v in self.values):
+            self.value_tokens = [json.dumps(v) for v in self.values]
+        # Rules that can reject a message without decoding it: missing key or missing values
+        self.raw_reject = self.value_tokens is not None or (self.operator == 'exists' and self.present)
+
+    def _prefilter(self, raw):
+        '''Returns False if the rule can be decided without decoding the message, True otherwise'''
+        if self.key_token in raw:
+            if self.value_tokens is None:
+                return True
+            return any(t in raw for t in self.value_tokens)
+        return False
+
+    def match(self, message):
+        if not self._prefilter(message.raw):
+            # The key or all the expected values are missing from the message
+            return self.operator == 'exists' and not self.present
+        if self.operator == 'exists':
+            for v in lookup(message.data, self.path):
+                return self.present
+            return not self.present
+        for v in lookup(message.data, self.path):
+            for expected in self.values:
+                # JSON types: true is not 1
+                if v == expected and isinstance(v, bool) == isinstance(expected, bool):
+                    return True
+        return False
+
+
+class Route(object):
+
+    def __init__(self, rules):
+        if isinstance(rules, dict):
+            rules = [rules]
+        if not isinstance(rules, list):
+            raise ValueError('Routing rules must be a list: {}'.format(rules))
+        self.rules = [Rule(r) for r in rules]
+        # Run the cheapest rules first: the ones that can be rejected on the raw message
+        self.rules.sort(key=lambda r: not r.raw_reject)
+
+    def match(self, message):
+        return all(r.match(message) for r in self.rules)
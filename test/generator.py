@@ -25,6 +25,7 @@ while True:
     r.publish(pipeline['Entry']['source-queue'],
               json.dumps({'uuid': str(uuid.uuid4()),
                           'run_at': message + random.randint(0, 20),
+                          'type': random.choice(['Event', 'Attribute']),
                           'content': message}))
     nb += 1
     if nb % 100 == 0:
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import fnmatch
+import json
+import os
+import runpy
+import unittest
+
+from simplequeue import QueueManager, get_partitions
+from simplequeue import Helper
+
+managment = runpy.run_path(os.path.join(os.path.dirname(__file__), '..', 'bin', 'managment.py'),
+                           run_name='managment')
+Manager = managment['Manager']
+
+
+class StubRedis(object):
+    '''The few commands used by Manager.balance_partitions and QueueManager to fill the partitions'''
+
+    def __init__(self):
+        self.hashes = {}
+        self.lists = {}
+        self.sets = {}
+        self.zsets = {}
+
+    def pipeline(self):
+        return StubPipeline(self)
+
+    def rpush(self, key, *values):
+        self.lists.setdefault(key, []).extend(values)
+
+    def lrange(self, key, start, end):
+        return self.lists.get(key, [])[start:end + 1 if end >= 0 else None]
+
+    def lpop(self, key):
+        if self.lists.get(key):
+            return self.lists[key].pop(0)
+
+    def sadd(self, key, *values):
+        self.sets.setdefault(key, set()).update(values)
+
+    def spop(self, key):
+        if self.sets.get(key):
+            return self.sets[key].pop()
+
+    def scard(self, key):
+        return len(self.sets.get(key, ()))
+
+    def scan_iter(self, match):
+        return [k for k in list(self.lists) + list(self.sets) + list(self.zsets) if fnmatch.fnmatchcase(k, match)]
+
+    def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    def zrangebyscore(self, key, low, high):
+        zset = self.zsets.get(key, {})
+        return sorted((v for v in zset if low <= zset[v] <= high), key=lambda v: zset[v])
+
+    def zremrangebyscore(self, key, low, high):
+        for v in self.zrangebyscore(key, low, high):
+            del self.zsets[key][v]
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(str(field))
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[str(field)] = str(value)
+
+    def register_script(self, script):
+        # MOVE_PARTITION
+        def move_partition(keys, args):
+            if self.hget(keys[1], 'partition') == str(args[0]):
+                return 0
+            self.hset(keys[0], args[0], args[1])
+            return 1
+        return move_partition
+
+
+class StubPipeline(object):
+    '''Transaction: the calls are run on execute'''
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args):
+            self.calls.append((getattr(self.redis, name), args))
+        return call
+
+    def execute(self):
+        return [f(*args) for f, args in self.calls]
+
+
+class TestBalancePartitions(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = Manager.__new__(Manager)
+        self.manager.default_redis = StubRedis()
+        self.manager.move_partition = self.manager.default_redis.register_script(managment['MOVE_PARTITION'])
+
+    def configure(self, partitions):
+        self.manager.default_redis.hset('config_M', 'partitions', partitions)
+
+    def assignment(self):
+        return self.manager.default_redis.hgetall('partitions_M')
+
+    def owned(self):
+        owned = {}
+        for partition, pid in self.assignment().items():
+            owned.setdefault(pid, set()).add(partition)
+        return owned
+
+    def test_not_partitioned(self):
+        self.manager.balance_partitions('M', [1, 2])
+        self.assertEqual(self.assignment(), {})
+
+    def test_first_assignment(self):
+        self.configure(8)
+        self.manager.balance_partitions('M', [1, 2])
+        self.assertEqual(sorted(self.assignment()), [str(i) for i in range(8)])
+        self.assertEqual(sorted(len(p) for p in self.owned().values()), [4, 4])
+
+    def test_grow(self):
+        self.configure(8)
+        self.manager.balance_partitions('M', [1, 2])
+        for pids, loads in [([1, 2, 3], [2, 3, 3]), ([1, 2, 3, 4], [2, 2, 2, 2])]:
+            before = self.assignment()
+            self.manager.balance_partitions('M', pids)
+            after = self.assignment()
+            self.assertEqual(sorted(after), [str(i) for i in range(8)])
+            self.assertEqual(sorted(len(p) for p in self.owned().values()), loads)
+            # Only the partitions of the new process moved
+            moved = [p for p in after if after[p] != before[p]]
+            self.assertEqual(set(after[p] for p in moved), set([str(pids[-1])]))
+            self.assertEqual(len(moved), 2)
+            # Balanced already, nothing moves
+            self.manager.balance_partitions('M', pids)
+            self.assertEqual(self.assignment(), after)
+
+    def test_busy_partition(self):
+        self.configure(4)
+        self.manager.balance_partitions('M', [1])
+        # Process 1 is processing a message of partition 3: it keeps it and gives up idle ones
+        self.manager.default_redis.hset('module_M_1', 'partition', 3)
+        self.manager.balance_partitions('M', [1, 2])
+        self.assertEqual(self.owned(), {'1': set(['0', '3']), '2': set(['1', '2'])})
+        # Balanced, nothing moves once the message is processed
+        self.manager.default_redis.hset('module_M_1', 'partition', '')
+        self.manager.balance_partitions('M', [1, 2])
+        self.assertEqual(self.owned(), {'1': set(['0', '3']), '2': set(['1', '2'])})
+
+    def test_refused_move(self):
+        self.configure(4)
+        self.manager.balance_partitions('M', [1])
+        move_partition = self.manager.move_partition
+        refused = []
+
+        def racing_move_partition(keys, args):
+            # The owner pops a message of the first partition handed over, right before the move
+            if not refused:
+                refused.append(args[0])
+                self.manager.default_redis.hset(keys[1], 'partition', args[0])
+            return move_partition(keys, args)
+
+        self.manager.move_partition = racing_move_partition
+        self.manager.balance_partitions('M', [1, 2])
+        # Refused, and replaced by the other idle partitions
+        self.assertEqual(refused, [3])
+        self.assertEqual(self.owned(), {'1': set(['0', '3']), '2': set(['1', '2'])})
+
+    def test_dead_owner(self):
+        self.configure(6)
+        self.manager.balance_partitions('M', [1, 2, 3])
+        lost = self.owned()['3']
+        # A dead process can't be processing anything, whatever its flag says
+        self.manager.default_redis.hset('module_M_3', 'partition', sorted(lost)[0])
+        self.manager.balance_partitions('M', [1, 2, 4])
+        owned = self.owned()
+        self.assertNotIn('3', owned)
+        self.assertEqual(owned['4'], lost)
+        self.assertEqual(sorted(len(p) for p in owned.values()), [2, 2, 2])
+        # Restarted with less processes
+        self.manager.balance_partitions('M', [5])
+        self.assertEqual(self.owned(), {'5': set(str(i) for i in range(6))})
+
+
+class TestPartition(unittest.TestCase):
+
+    def queue(self, key, partitions):
+        queue = QueueManager.__new__(QueueManager)
+        queue.partition_path = key.split('.')
+        queue.partitions = partitions
+        return queue
+
+    def test_stable(self):
+        queue = self.queue('Event.orgc_id', 16)
+        # crc32 of the JSON encoded key, independent of the process and of the python version
+        self.assertEqual(queue.partition({'Event': {'orgc_id': '1'}}), 10)
+        self.assertEqual(queue.partition({'Event': {'orgc_id': 1}}), 7)
+        self.assertEqual(queue.partition({'Event': {'orgc_id': 'é'}, 'uuid': 'a'}),
+                         queue.partition({'Event': {'orgc_id': 'é'}, 'uuid': 'b'}))
+        self.assertEqual(queue.partition({'Event': {'orgc_id': {'a': 1, 'b': 2}}}),
+                         queue.partition({'Event': {'orgc_id': {'b': 2, 'a': 1}}}))
+        for i in range(100):
+            self.assertIn(queue.partition({'Event': {'orgc_id': i}}), range(16))
+
+    def test_missing_key(self):
+        queue = self.queue('Event.orgc_id', 16)
+        self.assertEqual(queue.partition({'uuid': 'a'}), queue.partition({'Event': {}}))
+        self.assertEqual(queue.partition({'uuid': 'a'}), queue.partition({'Event': {'orgc_id': None}}))
+
+    def test_list(self):
+        queue = self.queue('Event.Tag.name', 16)
+        self.assertEqual(queue.partition({'Event': {'Tag': [{'name': 'a'}, {'name': 'b'}]}}),
+                         queue.partition({'Event': {'Tag': {'name': 'a'}}}))
+
+    def test_single_partition(self):
+        queue = self.queue('uuid', 1)
+        self.assertEqual(queue.partition({'uuid': 'a'}), 0)
+
+
+class StubLog(object):
+
+    def __init__(self):
+        self.warnings = []
+
+    def warning(self, entry):
+        self.warnings.append(entry)
+
+
+class FakeTime(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class TestPushIn(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = QueueManager.__new__(QueueManager)
+        self.queue.r_temp = StubRedis()
+        self.queue.in_set = 'Min'
+        self.queue.module_name = 'M'
+        self.queue.log = StubLog()
+        self.queue.partition_key = 'uuid'
+        self.queue.partition_path = ['uuid']
+        self.queue.partitions = 4
+        self.time = Helper.time
+        Helper.time = FakeTime(1000)
+
+    def tearDown(self):
+        Helper.time = self.time
+
+    def pushed(self):
+        return [json.loads(m) for k in sorted(self.queue.r_temp.lists) for m in self.queue.r_temp.lists[k]]
+
+    def test_delayed(self):
+        msg = {'uuid': 'a', 'run_at': 1100}
+        self.queue.r_temp.zadd('Min_delayed', {json.dumps(msg): msg['run_at']})
+        for i in range(5):
+            self.queue.check_delayed()
+        self.assertEqual(self.pushed(), [])
+        Helper.time.now = 1100
+        for i in range(5):
+            self.queue.check_delayed()
+        # Pushed once, to its partition, without run_at
+        self.assertEqual(list(self.queue.r_temp.lists), ['Min_{}'.format(self.queue.partition(msg))])
+        self.assertEqual(self.pushed(), [{'uuid': 'a'}])
+        self.assertEqual(self.queue.r_temp.zsets['Min_delayed'], {})
+
+    def test_leftover_partitions(self):
+        # Used to have 8 partitions
+        r = self.queue.r_temp
+        r.rpush('Min_1', json.dumps({'uuid': 'a'}))
+        r.rpush('Min_6', *[json.dumps({'uuid': u, 'n': i}) for i, u in enumerate('bcbd')])
+        r.zadd('Min_delayed', {json.dumps({'uuid': 'e', 'run_at': 2000}): 2000})
+        self.queue.requeue_leftovers()
+        self.assertNotIn('Min_6', [k for k in r.lists if r.lists[k]])
+        self.assertEqual(len(r.zsets['Min_delayed']), 1)
+        pushed = self.pushed()
+        self.assertEqual(sorted(m['uuid'] for m in pushed), ['a', 'b', 'b', 'c', 'd'])
+        # The order of the messages of a key is kept
+        self.assertEqual([m['n'] for m in pushed if m['uuid'] == 'b'], [0, 2])
+        # Partitions still in range are left alone
+        self.assertEqual(r.lists['Min_1'][0], json.dumps({'uuid': 'a'}))
+        for m in pushed:
+            if m['uuid'] != 'a':
+                self.assertIn(json.dumps(m), r.lists['Min_{}'.format(self.queue.partition(m))])
+        self.assertEqual(len(self.queue.log.warnings), 1)
+        self.assertIn('Min_6', self.queue.log.warnings[0])
+
+    def test_leftover_set(self):
+        # Wasn't partitioned
+        self.queue.r_temp.sadd('Min', json.dumps({'uuid': 'a'}), json.dumps({'uuid': 'b'}))
+        self.queue.requeue_leftovers()
+        self.assertEqual(self.queue.r_temp.scard('Min'), 0)
+        self.assertEqual(sorted(m['uuid'] for m in self.pushed()), ['a', 'b'])
+        self.assertEqual(len(self.queue.log.warnings), 1)
+
+    def test_no_longer_partitioned(self):
+        self.queue.partition_key = None
+        self.queue.partitions = None
+        self.queue.r_temp.rpush('Min_0', json.dumps({'uuid': 'a'}))
+        self.queue.requeue_leftovers()
+        self.assertEqual(self.pushed(), [])
+        self.assertEqual(self.queue.r_temp.sets['Min'], set([json.dumps({'uuid': 'a'})]))
+        self.assertEqual(len(self.queue.log.warnings), 1)
+
+
+class TestGetPartitions(unittest.TestCase):
+
+    def test_get_partitions(self):
+        self.assertIsNone(get_partitions('M', {}))
+        self.assertIsNone(get_partitions('M', {'partitions': 4}))
+        self.assertEqual(get_partitions('M', {'partition-key': 'uuid', 'partitions': 4}), 4)
+        for partitions in [None, 0, -1, True, '4', 1.5]:
+            config = {'partition-key': 'uuid'}
+            if partitions is not None:
+                config['partitions'] = partitions
+            self.assertRaises(ValueError, get_partitions, 'M', config)
+
+
+if __name__ == '__main__':
+    unittest.main()
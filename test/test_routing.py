@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import runpy
+import shutil
+import tempfile
+import unittest
+
+from simplequeue import get_routing
+from simplequeue.routing import Message, Route, Rule
+
+
+def match(rules, msg):
+    return Route(rules).match(Message(json.dumps(msg)))
+
+
+class TestRule(unittest.TestCase):
+
+    def test_equals(self):
+        self.assertTrue(match({'field': 'type', 'equals': 'Event'}, {'type': 'Event'}))
+        self.assertFalse(match({'field': 'type', 'equals': 'Event'}, {'type': 'Attribute'}))
+        self.assertFalse(match({'field': 'type', 'equals': 'Event'}, {'uuid': 'Event'}))
+        self.assertTrue(match({'field': 'level', 'equals': 2}, {'level': 2}))
+        self.assertTrue(match({'field': 'level', 'equals': 2}, {'level': 2.0}))
+
+    def test_in(self):
+        rule = {'field': 'type', 'in': ['Event', 'Attribute']}
+        self.assertTrue(match(rule, {'type': 'Attribute'}))
+        self.assertFalse(match(rule, {'type': 'Object'}))
+
+    def test_json_types(self):
+        self.assertFalse(match({'field': 'a', 'equals': True}, {'a': 1}))
+        self.assertFalse(match({'field': 'a', 'in': [1]}, {'a': True}))
+        self.assertTrue(match({'field': 'a', 'equals': True}, {'a': True}))
+        self.assertFalse(match({'field': 'a', 'equals': '1'}, {'a': 1}))
+
+    def test_exists(self):
+        self.assertTrue(match({'field': 'Event.Attribute', 'exists': True}, {'Event': {'Attribute': [{'value': 1}]}}))
+        self.assertFalse(match({'field': 'Event.Attribute', 'exists': True}, {'Event': {'Attribute': []}}))
+        self.assertFalse(match({'field': 'Event.Attribute', 'exists': True}, {'Event': {}}))
+        # The key is in the raw message, but not at this path
+        self.assertFalse(match({'field': 'Event.Attribute', 'exists': True}, {'Attribute': 1}))
+
+    def test_not_exists(self):
+        rule = {'field': 'Event.Attribute', 'exists': False}
+        self.assertTrue(match(rule, {'Event': {}}))
+        self.assertTrue(match(rule, {'Attribute': 1}))
+        self.assertFalse(match(rule, {'Event': {'Attribute': None}}))
+
+    def test_lists(self):
+        rule = {'field': 'Event.Tag.name', 'equals': 'tlp:white'}
+        self.assertTrue(match(rule, {'Event': {'Tag': [{'name': 'tlp:red'}, {'name': 'tlp:white'}]}}))
+        self.assertFalse(match(rule, {'Event': {'Tag': [{'name': 'tlp:red'}]}}))
+        self.assertTrue(match({'field': 'tags', 'equals': 'b'}, {'tags': ['a', 'b']}))
+        self.assertTrue(match({'field': 'Events.type', 'equals': 'x'}, {'Events': [{'type': 'y'}, [{'type': 'x'}]]}))
+
+    def test_all_rules(self):
+        rules = [{'field': 'type', 'equals': 'Event'}, {'field': 'tags', 'exists': True}]
+        self.assertTrue(match(rules, {'type': 'Event', 'tags': ['a']}))
+        self.assertFalse(match(rules, {'type': 'Event'}))
+        self.assertFalse(match(rules, {'type': 'Attribute', 'tags': ['a']}))
+
+    def test_prefilter_no_false_negative(self):
+        # Escaped and non-ASCII strings have the same representation in the rule and in the message
+        for value in [u'é', u'a"b', u'a\\b', u'tab\t', u'/', u' ', u'😀']:
+            for key in [u'name', u'clé', u'k"ey']:
+                self.assertTrue(match({'field': key, 'equals': value}, {key: value}), (key, value))
+                self.assertTrue(match({'field': key, 'in': ['x', value]}, {key: value}), (key, value))
+                self.assertTrue(match({'field': key, 'exists': True}, {key: value}), (key, value))
+
+    def test_reject_without_decode(self):
+        msg = Message(json.dumps({'type': 'Attribute'}))
+        self.assertFalse(Route({'field': 'type', 'equals': 'Event'}).match(msg))
+        self.assertFalse(Route({'field': 'tags', 'exists': True}).match(msg))
+        self.assertTrue(Route({'field': 'tags', 'exists': False}).match(msg))
+        self.assertIsNone(msg._data)
+        # A number cannot be checked on the raw message
+        self.assertFalse(Route({'field': 'type', 'equals': 1}).match(msg))
+        self.assertIsNotNone(msg._data)
+
+    def test_order(self):
+        route = Route([{'field': 'a', 'exists': False}, {'field': 'b', 'equals': 1},
+                       {'field': 'c', 'exists': True}, {'field': 'd', 'equals': 'x'}])
+        self.assertEqual([r.path[0] for r in route.rules], ['c', 'd', 'a', 'b'])
+
+    def test_validation(self):
+        for rule in [{'equals': 'x'}, {'field': 'a'}, {'field': 'a', 'equals': 'x', 'exists': True},
+                     {'field': 'a', 'in': 'x'}, {'field': 1, 'equals': 'x'}, {'field': ['a'], 'exists': True},
+                     'a', ['a']]:
+            self.assertRaises(ValueError, Rule, rule)
+        self.assertRaises(ValueError, Route, 'a')
+        self.assertRaises(ValueError, Route, ['a'])
+
+
+class TestGetRouting(unittest.TestCase):
+
+    def test_get_routing(self):
+        self.assertEqual(get_routing('M', {}), {})
+        routes = get_routing('M', {'routing': {'A': [{'field': 'type', 'equals': 'Event'}], 'B': []}})
+        self.assertEqual(list(routes), ['A'])
+        self.assertEqual(len(routes['A'].rules), 1)
+
+    def test_errors(self):
+        for routing in [['A'], 'A', {'A': 'x'}, {'A': [{'field': 'type', 'equal': 'Event'}]},
+                        {'A': [{'field': 'type', 'in': 'Event'}]}]:
+            with self.assertRaises(ValueError) as e:
+                get_routing('M', {'routing': routing})
+            self.assertTrue(str(e.exception).startswith('M'), str(e.exception))
+
+
+class TestManagerConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = runpy.run_path(os.path.join(os.path.dirname(__file__), '..', 'bin', 'managment.py'),
+                                      run_name='managment')['Manager']
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            json.dump(content, f)
+        return path
+
+    def test_invalid_routing(self):
+        pipeline = self.write('pipeline.conf', {'Entry': {'source-queue': 'Feed', 'destination-queues': ['A'],
+                                                          'routing': {'A': [{'field': 'type', 'equal': 'x'}]}}})
+        runtime = self.write('runtime.conf', {'Default': {'host': 'localhost', 'port': 6379, 'db': 0}})
+        startup = self.write('startup.conf', {})
+        # Before connecting to redis and launching anything
+        with self.assertRaises(ValueError) as e:
+            self.manager(pipeline, runtime, startup)
+        self.assertTrue(str(e.exception).startswith('Entry (routing to A)'), str(e.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()